@@ -12,13 +12,17 @@ SERVICE_DESCR="SMS to shell service"
 SERVICE_FILE="/lib/systemd/system/$SERVICE_NAME.service"
 INSTALL_DIR="/opt/$SERVICE_NAME"
 PYTHON_SCRIPT="sms-to-shell.py"
+CONFIG_FILE="sms-to-shell.conf"
 SHELL_USER="root" # Commands will run in this user context.
 
 # Create installation directory
 sudo mkdir -p $INSTALL_DIR
 
-# Copy Python script to installation directory
+# Copy Python script and optional config file to installation directory
 sudo cp $PYTHON_SCRIPT $INSTALL_DIR
+if [ -f $CONFIG_FILE ]; then
+    sudo cp $CONFIG_FILE $INSTALL_DIR
+fi
 
 # Create systemd service file
 sudo tee $SERVICE_FILE > /dev/null << EOF
@@ -28,6 +32,7 @@ After=multi-user.target
 
 [Service]
 ExecStart=/usr/bin/python3 $INSTALL_DIR/$PYTHON_SCRIPT
+ExecReload=/bin/kill -HUP \$MAINPID
 WorkingDirectory=$INSTALL_DIR
 Restart=always
 RestartSec=5
@@ -12,8 +12,18 @@ import re
 import logging
 import os
 import logging.handlers
+import configparser
+import codecs
+import signal
+import concurrent.futures
+import collections
+import glob
 import pyotp
 
+# OPTIONAL CONFIG FILE. Any setting in the sections below may instead be set in this file, which is validated at startup
+# and reloaded on SIGHUP (systemctl reload sms-to-shell) or when the file changes. See sms-to-shell.conf for the format.
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sms-to-shell.conf')
+
 # USER DEFINABLE SECURITY SETTINGS
 OTP_ENABLED = False  # Enable OTP security
 TOTP_SECRET_KEY = 'run otp-setup.py and add secret key value from otp-key.txt here'
@@ -35,6 +45,12 @@ PURGE_ALL_ON_START = False  # False = process commands sent while offline. True
 PURGE_ALL_SMS = 'AT+CMGD=1,4'  # Command to purge all SMS messages in all modem storage
 PURGE_PROC_SMS = 'AT+CMGD=1,2'  # Command to purge only "received read" or "stored sent" messages from modem storage.
 DEL_SMS_BATCH = 10  # Threshold of stored "READ" messages to trigger a batch delete. (Check modem storage capacity with AT+CPMS?)
+SMS_SEND_TIMEOUT = 60  # Time in seconds to wait for the network to confirm a sent SMS reply before it is treated as lost
+WATCHDOG_MAX_FAILED_PROBES = 3  # Consecutive unanswered AT probes before the modem is treated as hung and reconnected
+WATCHDOG_RETRY_MIN = 2  # Time in seconds before the first modem reconnect attempt, doubling after each failed attempt
+WATCHDOG_RETRY_MAX = 60  # Longest time in seconds between modem reconnect attempts
+REPLY_QUEUE_SIZE = 20  # SMS replies kept to resend after a modem reconnect. Oldest replies are dropped first when full. 0 = disable
+REPLY_QUEUE_MAX_AGE = 600  # Time in seconds after which a queued SMS reply is dropped instead of being resent
 LOG_ROTATE_COUNT = 2  # Security logs to keep in rotation before overwrite
 CURRENT_DIR = '/root'  # Default current directory path for the SMS interactive user
 LOG_FILE_NAME = 'sms-to-shell.log'  # Log file name
@@ -43,11 +59,29 @@ MAX_LOG_FILE_SIZE = 64 * 1024  # Maximum log file size in bytes (E.g. 64k = 64 *
 PING_COUNT = 8  # Number of test pings to send before stopping (we don't want an endless stream of ping replies over SMS!)
 CMD_PASS_MSG = 'OK'  # Feedback to append to successful commands
 CMD_FAIL_MSG = 'Command failed'  # Feedback to append to failed commands
+BATCH_DELIMITER = ';;'  # Separator between commands in a batch SMS e.g. "BATCH f1;; uname -a;; ping 8.8.8.8"
+BATCH_TIMEOUT = 60  # Time in seconds allowed for all commands in a batch to finish before the merged reply is sent
+BATCH_MAX_COMMANDS = 5  # Maximum number of commands in one batch SMS
+
+# USER DEFINABLE POWER SAVING PARAMETERS
+POLL_MIN_INTERVAL = 1  # Seconds between SMS polls while active (set POLL_MAX_INTERVAL to the same value for fixed polling)
+POLL_MAX_INTERVAL = 30  # Longest idle gap in seconds between SMS polls after exponential back off
+POLL_BACKOFF_FACTOR = 2  # Multiplier applied to the poll interval each idle poll once the active period has expired
+POLL_ACTIVE_PERIOD = 180  # Seconds to keep polling at POLL_MIN_INTERVAL after the last SMS activity
+MODEM_NEW_MSG_IND = 'AT+CNMI=2,1'  # Have the modem push +CMTI notifications so new SMS wake the poll loop early
+MODEM_SLEEP_ENABLED = False  # True = let the modem sleep between polls (needs the modem DTR line wired to the host)
+MODEM_SLEEP_CONFIG = 'AT+CSCLK=1'  # Modem sleep mode controlled by DTR. Check modem docs
+MODEM_WAKE_DELAY = 0.1  # Time in seconds for the modem to wake after DTR is asserted before AT commands are sent
+WAKE_ON_RI = False  # True = also watch the modem RI (ring indicator) line for early wake (needs RI wired to the host)
+POWER_STATS_INTERVAL = 3600  # Seconds between power counter log entries. 0 = disable
 
 # USER DEFINABLE KEYWORD SHORTCUTS. USE UPPERCASE FOR KEYWORD TAGS: e.g  KEYWORD_1 = "UPPERCASE_VALUE"
 # Keyword shortcut case is INGNORED when sending SMS commands.
 KEYWORD_PROCESS_LIST = 'PL'  # Built-in command to send a running process list formatted optimally for SMS
 KEYWORD_PING = 'PING'  # Built-in command to test the network and send response info via sms'
+KEYWORD_POWER_STATS = 'PWR'  # Built-in command to send the poll loop wakeup and modem awake time counters via sms
+KEYWORD_MODEM_STATS = 'MDM'  # Built-in command to send the modem watchdog reconnect and recovery time counters via sms
+KEYWORD_BATCH = 'BATCH'  # Built-in prefix to run several BATCH_DELIMITER separated commands at once with one merged reply
 
 KEYWORD_1 = 'F1'
 KEYWORD_1_CMD = 'echo "Hello World!"'
@@ -94,6 +128,47 @@ formatter = logging.Formatter('%(message)s')
 file_handler.setFormatter(formatter)
 # Add log file handler to logger
 logger.addHandler(file_handler)
+# Power saving counters for the poll loop (times are in seconds)
+power_stats = {'started': time.monotonic(), 'polls': 0, 'wakeups': 0, 'early_wakeups': 0, 'busy_seconds': 0.0,
+               'busy_since': time.monotonic(), 'last_report': time.monotonic()}
+# Settings that may be overridden in CONFIG_FILE, grouped by config file section. Value types follow the defaults above
+# except for CONFIG_FLOAT_SETTINGS.
+CONFIG_SECTIONS = {
+    'security': ['OTP_ENABLED', 'TOTP_SECRET_KEY', 'RESTRICT_COMMANDS', 'ACL'],
+    'modem': ['MODEM', 'MODEM_BAUD_RATE', 'GPS_CONFIG', 'MODEM_MSG_FORMAT', 'MODEM_MSG_STOR', 'MODEM_CHAR_ENCODING',
+              'MODEM_CHAR_SET', 'MODEM_TXT_MODE_PARAM', 'MODEM_DELAY', 'PURGE_ALL_ON_START', 'PURGE_ALL_SMS',
+              'PURGE_PROC_SMS', 'DEL_SMS_BATCH', 'SMS_SEND_TIMEOUT', 'WATCHDOG_MAX_FAILED_PROBES',
+              'WATCHDOG_RETRY_MIN', 'WATCHDOG_RETRY_MAX', 'REPLY_QUEUE_SIZE', 'REPLY_QUEUE_MAX_AGE'],
+    'script': ['MAX_SMS_LENGTH', 'LOG_ROTATE_COUNT', 'CURRENT_DIR', 'LOG_FILE_NAME', 'LOG_FILE_PATH',
+               'MAX_LOG_FILE_SIZE', 'PING_COUNT', 'CMD_PASS_MSG', 'CMD_FAIL_MSG', 'BATCH_DELIMITER', 'BATCH_TIMEOUT',
+               'BATCH_MAX_COMMANDS'],
+    'power': ['POLL_MIN_INTERVAL', 'POLL_MAX_INTERVAL', 'POLL_BACKOFF_FACTOR', 'POLL_ACTIVE_PERIOD', 'MODEM_NEW_MSG_IND',
+              'MODEM_SLEEP_ENABLED', 'MODEM_SLEEP_CONFIG', 'MODEM_WAKE_DELAY', 'WAKE_ON_RI', 'POWER_STATS_INTERVAL'],
+    'keywords': ['KEYWORD_PROCESS_LIST', 'KEYWORD_PING', 'KEYWORD_POWER_STATS', 'KEYWORD_MODEM_STATS', 'KEYWORD_BATCH']
+                + [f'KEYWORD_{i}{suffix}' for i in range(1, 11) for suffix in ('', '_CMD')],
+}
+# Settings sent to the modem only when the serial port is opened. Changes to these are reported on reload, not applied.
+# MODEM_CHAR_ENCODING is included so the script never encodes with a character set the modem has not been switched to.
+MODEM_INIT_SETTINGS = ['MODEM', 'MODEM_BAUD_RATE', 'GPS_CONFIG', 'MODEM_MSG_FORMAT', 'MODEM_MSG_STOR', 'MODEM_CHAR_SET',
+                       'MODEM_CHAR_ENCODING', 'MODEM_TXT_MODE_PARAM', 'MODEM_NEW_MSG_IND', 'MODEM_SLEEP_ENABLED',
+                       'MODEM_SLEEP_CONFIG']
+# Time in seconds and multiplier settings that accept fractional values whatever the type of their default
+CONFIG_FLOAT_SETTINGS = ['MODEM_DELAY', 'POLL_MIN_INTERVAL', 'POLL_MAX_INTERVAL', 'POLL_BACKOFF_FACTOR',
+                         'POLL_ACTIVE_PERIOD', 'MODEM_WAKE_DELAY', 'BATCH_TIMEOUT', 'WATCHDOG_RETRY_MIN',
+                         'WATCHDOG_RETRY_MAX', 'REPLY_QUEUE_MAX_AGE', 'SMS_SEND_TIMEOUT']
+# Settings that must be greater than zero. All other number settings must not be negative.
+CONFIG_POSITIVE_SETTINGS = ['MODEM_BAUD_RATE', 'DEL_SMS_BATCH', 'MAX_SMS_LENGTH', 'MAX_LOG_FILE_SIZE', 'PING_COUNT',
+                            'SMS_SEND_TIMEOUT', 'POLL_MIN_INTERVAL', 'POLL_MAX_INTERVAL', 'BATCH_TIMEOUT',
+                            'BATCH_MAX_COMMANDS', 'WATCHDOG_MAX_FAILED_PROBES', 'WATCHDOG_RETRY_MIN', 'WATCHDOG_RETRY_MAX']
+# Script defaults that config file values are applied over, and the config file state for change detection
+config_defaults = {name: globals()[name] for names in CONFIG_SECTIONS.values() for name in names}
+config_state = {'mtime': None, 'reload_requested': False}
+# Modem watchdog counters and state (times are in seconds). by_id is the /dev/serial/by-id link found for MODEM and
+# failed_since is when the current modem failure was first seen.
+watchdog_stats = {'failed_probes': 0, 'failed_since': None, 'reconnects': 0, 'last_recovery': 0.0,
+                  'longest_recovery': 0.0, 'total_downtime': 0.0, 'by_id': None}
+# SMS replies that could not be sent because the modem failed, resent once the modem answers again
+reply_queue = collections.deque(maxlen=REPLY_QUEUE_SIZE)
 
 ############ START OF SCRIPT ACTIONS ############
 
@@ -115,31 +190,70 @@ def send_sms_response(modem, phone_number, command):
         modem.read_until(b'> ')
         modem.write(command.encode(MODEM_CHAR_ENCODING))
         modem.write(bytes([26]))  # Ctrl+Z
-        modem.read_until(b'+CMGS: ')
-        response = modem.read_until(b'OK\r\n')
+        # The network can take many seconds to confirm an SMS, so wait up to SMS_SEND_TIMEOUT for +CMGS or ERROR
+        response = read_final_result(modem, SMS_SEND_TIMEOUT)
 
         # Check if the command was sent successfully
         sent_successfully = '+CMGS: ' in response.decode(MODEM_CHAR_ENCODING)
 
+        # Only treat no answer at all as a hung modem if a probe also fails. Keep a reply lost to a hung modem to resend
+        # once it answers again.
+        if not response and not probe_modem(modem):
+            queue_sms_response(phone_number, command)
+
         # Add a small delay between SMS messages
         time.sleep(0.5)
 
         return sent_successfully
+    except (serial.SerialException, OSError) as e:
+        logger.error('An error occurred while sending an SMS command: %s', str(e))
+        queue_sms_response(phone_number, command)
+        return False
     except Exception as e:
         logger.error('An error occurred while sending an SMS command: %s', str(e))
         return False
 
 
-# Run SMS commands in the shell
-def execute_shell_command(command):
+# Keep an SMS reply that could not be sent for resending once the modem answers again
+def queue_sms_response(phone_number, command):
+    if not reply_queue.maxlen:
+        return
+    if len(reply_queue) == reply_queue.maxlen:
+        logger.warning('SMS reply queue full, dropping oldest reply to %s', reply_queue[0][0])
+    reply_queue.append((phone_number, command, time.monotonic()))
+
+
+# Resend SMS replies queued while the modem was down or hung. Replies older than REPLY_QUEUE_MAX_AGE are dropped rather than
+# sent late, and replies that fail again are queued again by send_sms_response.
+def flush_sms_responses(modem):
+    pending = list(reply_queue)
+    reply_queue.clear()
+    for phone_number, command, queued in pending:
+        if time.monotonic() - queued > REPLY_QUEUE_MAX_AGE:
+            logger.warning('Dropping SMS reply to %s queued %.0fs ago', phone_number, time.monotonic() - queued)
+            continue
+        send_sms_response(modem, phone_number, command)
+
+
+# Run SMS commands in the shell, optionally stopping the command after timeout seconds
+def execute_shell_command(command, timeout=None):
     try:
-        output = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT)
+        # Start the shell in its own process group so a timeout stops every process of a compound command, not just
+        # the /bin/sh parent
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   start_new_session=True)
+        try:
+            output, _ = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            output, _ = process.communicate()
+            logger.error('Command timed out after %s seconds: %s', timeout, command)
+            return output.decode(MODEM_CHAR_ENCODING) + f'\nTimed out after {timeout:.0f}s'
+
+        if process.returncode != 0:
+            logger.error('Command execution failed with error: %s', output.decode(MODEM_CHAR_ENCODING))
         return output.decode(MODEM_CHAR_ENCODING)
 
-    except subprocess.CalledProcessError as e:
-        logger.error('Command execution failed with error: %s', e.output.decode(MODEM_CHAR_ENCODING))
-        return str(e.output.decode(MODEM_CHAR_ENCODING))
-
     except Exception as e:
         logger.error('An error occurred while executing the shell command: %s', str(e))
         return str(e)
@@ -166,34 +280,17 @@ def parse_sms(sms):
         return None, None
 
 
-# Create the built-in SMS optimised process list
-def send_process_list(modem, phone_number):
-    try:
-        command = 'ps -d -o pid,cmd --no-headers | awk \'!/^\[.*\]/{gsub(/[^a-zA-Z0-9_./-]/, "", $2); gsub(/\\x27/, "\\\\x27", $2); print $1, $2}\''
-        output = execute_shell_command(command)
-
-        # Check for empty error in output
-        if not output:
-            raise ValueError("Empty process list")
-
-        # Paginate and send the process list as SMS
-        pages = paginate_output(modem, output)
-        num_pages = len(pages)
-
-        for i, page in enumerate(pages):
-            page_number = f"{i+1}/{num_pages}"
-            message = page_number + ' ' + page
-            send_sms_response(modem, phone_number, message)
-
-    except Exception as e:
-        logger.error('An error occurred in send_process_list function: %s', str(e))
+# Run the built-in SMS optimised process list command
+def get_process_list(timeout=None):
+    command = 'ps -d -o pid,cmd --no-headers | awk \'!/^\[.*\]/{gsub(/[^a-zA-Z0-9_./-]/, "", $2); gsub(/\\x27/, "\\\\x27", $2); print $1, $2}\''
+    return execute_shell_command(command, timeout)
 
 
 # Execute the built-in ping test with a limited number of pings
-def ping_host(target):
+def ping_host(target, timeout=None):
     try:
         command = f'ping -c {PING_COUNT} {target}'
-        output = execute_shell_command(command)
+        output = execute_shell_command(command, timeout)
         return output
 
     except subprocess.CalledProcessError as e:
@@ -208,41 +305,66 @@ def ping_host(target):
         return error_message
 
 
-# Package output from the built-in ping test for SMS reply 
-def send_ping_response(modem, phone_number, response, error_message=None):
-    try:
-        # Capture ping command errors up front
-        if error_message:
-            logger.error(error_message)  # Log the error message
-
-        # Split ping output into multi page SMS reply
-        pages = paginate_output(modem, response)
-        num_pages = len(pages)
-
-        for i, page in enumerate(pages):
-            page_number = f"{i+1}/{num_pages}"
-            message = page_number + ' ' + page
-            send_sms_response(modem, phone_number, message)
-
-    except Exception as e:
-        error_message = f"Failed to send ping response: {str(e)}"
-        logger.error(error_message)  # Log the error message
-
-
-# Built-in in kill <process id> command shortcut
-def kill_process(modem, phone_number, pid):
-    try:
-        # Execute the kill command with signal -9 and echo the exit status
-        command = f'kill -9 {pid} ; echo "exit status =" $?'
-        output = execute_shell_command(command)
-
-        # Send the kill command output as SMS
-        message = f"Kill output:\n{output}"
-        send_sms_response(modem, phone_number, message)
+# Append the CMD_PASS_MSG or CMD_FAIL_MSG feedback for the command exit status
+def add_status_check(command):
+    return command + ' ; command_status=$? ; if [ $command_status -eq 0 ]; then echo "' + CMD_PASS_MSG + '"; else echo "' + CMD_FAIL_MSG + '"; fi'
+
+
+# Run one SMS command, either a built-in keyword, a keyword shortcut or a shell command, and return its output
+def run_sms_command(content, phone_number, timeout=None):
+    keyword = content.strip().upper()
+    if keyword == KEYWORD_PROCESS_LIST:
+        # Process list
+        return get_process_list(timeout)
+    if keyword.startswith(KEYWORD_PING):
+        # Ping command
+        ping_args = content.strip().split()
+        if len(ping_args) < 2:
+            return f"Usage: {KEYWORD_PING} <host>"
+        return ping_host(ping_args[1], timeout)
+    if keyword == KEYWORD_POWER_STATS:
+        # Power saving counters
+        return format_power_stats()
+    if keyword == KEYWORD_MODEM_STATS:
+        # Modem watchdog counters
+        return format_watchdog_stats()
+
+    # Execute the matching KEYWORD_1 to KEYWORD_10 command
+    for i in range(1, 11):
+        if keyword == globals()[f'KEYWORD_{i}']:
+            return execute_shell_command(add_status_check(globals()[f'KEYWORD_{i}_CMD']), timeout)
+
+    # Built-in kill <process id> command shortcut with signal -9, echoing the exit status
+    match = re.match(r'^KILL\s+(\d+)$', keyword)
+    if match:
+        return 'Kill output:\n' + execute_shell_command(f'kill -9 {match.group(1)} ; echo "exit status =" $?', timeout)
+
+    # Execution of any sms command is allowed if RESTRICT_COMMANDS is set to False
+    if not RESTRICT_COMMANDS:
+        return execute_shell_command(add_status_check(content), timeout)
+
+    logger.warning("Unauthorised command - Phone Number: %s - Command: %s", phone_number, content)
+    return "Unauthorised command"
+
+
+# Run the commands of a batch SMS in parallel within BATCH_TIMEOUT and merge their labeled outputs into one reply
+def run_batch(commands, phone_number):
+    outputs = []
+    # Each shell command is stopped at BATCH_TIMEOUT, the extra second only covers thread start up and output decoding
+    deadline = time.monotonic() + BATCH_TIMEOUT + 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        futures = [executor.submit(run_sms_command, command, phone_number, BATCH_TIMEOUT) for command in commands]
+        for command, future in zip(commands, futures):
+            try:
+                outputs.append(future.result(timeout=max(deadline - time.monotonic(), 0)))
+            except concurrent.futures.TimeoutError:
+                outputs.append(f'Timed out after {BATCH_TIMEOUT}s')
+            except Exception as e:
+                logger.error('An error occurred while running batch command %s: %s', command, str(e))
+                outputs.append(str(e))
 
-    except Exception as e:
-        error_message = f"Failed to kill process {process_id}: {str(e)}"
-        logger.error(error_message)  # Log the error message
+    # Keep the batch order and label each output with its command
+    return '\n'.join(f'{command}:\n{output.strip()}' for command, output in zip(commands, outputs))
 
 
 # SMS central processing engine
@@ -293,96 +415,21 @@ def process_sms(modem, sms):
             # Separate the OTP from the message content
             content = command
 
-        if content.strip().upper() == KEYWORD_PROCESS_LIST:
-            # Send process list
-            send_process_list(modem, phone_number)
-            return
-        elif content.strip().upper().startswith(KEYWORD_PING):
-            # Ping command
-            ping_target = content.strip().split(' ')[1]
-            ping_response = ping_host(ping_target)
-            send_ping_response(modem, phone_number, ping_response)
-            return
-        elif content.strip().upper() == KEYWORD_1:
-            # Execute the KEYWORD_1 command
-            command = KEYWORD_1_CMD + ' ; command_status=$? ; if [ $command_status -eq 0 ]; then echo "' + CMD_PASS_MSG + '"; else echo "' + CMD_FAIL_MSG + '"; fi'
-            output = execute_shell_command(command)
-            build_sms_response(modem, phone_number, output)
-            return
-        elif content.strip().upper() == KEYWORD_2:
-            # Execute the KEYWORD_2 command
-            command = KEYWORD_2_CMD + ' ; command_status=$? ; if [ $command_status -eq 0 ]; then echo "' + CMD_PASS_MSG + '"; else echo "' + CMD_FAIL_MSG + '"; fi'
-            output = execute_shell_command(command)
-            build_sms_response(modem, phone_number, output)
-            return
-        elif content.strip().upper() == KEYWORD_3:
-            # Execute the KEYWORD_3 command
-            command = KEYWORD_3_CMD + ' ; command_status=$? ; if [ $command_status -eq 0 ]; then echo "' + CMD_PASS_MSG + '"; else echo "' + CMD_FAIL_MSG + '"; fi'
-            output = execute_shell_command(command)
-            build_sms_response(modem, phone_number, output)
-            return
-        elif content.strip().upper() == KEYWORD_4:
-            # Execute the KEYWORD_4 command
-            command = KEYWORD_4_CMD + ' ; command_status=$? ; if [ $command_status -eq 0 ]; then echo "' + CMD_PASS_MSG + '"; else echo "' + CMD_FAIL_MSG + '"; fi'
-            output = execute_shell_command(command)
-            build_sms_response(modem, phone_number, output)
-            return
-        elif content.strip().upper() == KEYWORD_5:
-            # Execute the KEYWORD_5 command
-            command = KEYWORD_5_CMD + ' ; command_status=$? ; if [ $command_status -eq 0 ]; then echo "' + CMD_PASS_MSG + '"; else echo "' + CMD_FAIL_MSG + '"; fi'
-            output = execute_shell_command(command)
-            build_sms_response(modem, phone_number, output)
-            return
-        elif content.strip().upper() == KEYWORD_6:
-            # Execute the KEYWORD_6 command
-            command = KEYWORD_6_CMD + ' ; command_status=$? ; if [ $command_status -eq 0 ]; then echo "' + CMD_PASS_MSG + '"; else echo "' + CMD_FAIL_MSG + '"; fi'
-            output = execute_shell_command(command)
-            build_sms_response(modem, phone_number, output)
-            return
-        elif content.strip().upper() == KEYWORD_7:
-            # Execute the KEYWORD_7 command
-            command = KEYWORD_7_CMD + ' ; command_status=$? ; if [ $command_status -eq 0 ]; then echo "' + CMD_PASS_MSG + '"; else echo "' + CMD_FAIL_MSG + '"; fi'
-            output = execute_shell_command(command)
-            build_sms_response(modem, phone_number, output)
-            return
-        elif content.strip().upper() == KEYWORD_8:
-            # Execute the KEYWORD_8 command
-            command = KEYWORD_8_CMD + ' ; command_status=$? ; if [ $command_status -eq 0 ]; then echo "' + CMD_PASS_MSG + '"; else echo "' + CMD_FAIL_MSG + '"; fi'
-            output = execute_shell_command(command)
-            build_sms_response(modem, phone_number, output)
-            return
-        elif content.strip().upper() == KEYWORD_9:
-            # Execute the KEYWORD_9 command
-            command = KEYWORD_9_CMD + ' ; command_status=$? ; if [ $command_status -eq 0 ]; then echo "' + CMD_PASS_MSG + '"; else echo "' + CMD_FAIL_MSG + '"; fi'
-            output = execute_shell_command(command)
-            build_sms_response(modem, phone_number, output)
-            return
-        elif content.strip().upper() == KEYWORD_10:
-            # Execute the KEYWORD_10 command
-            command = KEYWORD_10_CMD + ' ; command_status=$? ; if [ $command_status -eq 0 ]; then echo "' + CMD_PASS_MSG + '"; else echo "' + CMD_FAIL_MSG + '"; fi'
-            output = execute_shell_command(command)
-            build_sms_response(modem, phone_number, output)
-            return
-
-        # Check if the command is a kill command
-        kill_pattern = r'^KILL\s+(\d+)$'
-        match = re.match(kill_pattern, content.strip().upper())
-        if match:
-            pid = match.group(1)
-            kill_process(modem, phone_number, pid)
-            return
-
-        # Execution of any sms command is allowed if RESTRICT_COMMANDS is set to False
-        if not RESTRICT_COMMANDS:
-            command = content + ' ; command_status=$? ; if [ $command_status -eq 0 ]; then echo "' + CMD_PASS_MSG + '"; else echo "' + CMD_FAIL_MSG + '"; fi'
-            output = execute_shell_command(command)
-            build_sms_response(modem, phone_number, output)
+        if content.strip().upper().startswith(KEYWORD_BATCH + ' '):
+            # Run several commands at once and send one merged reply
+            commands = [command.strip() for command in content.strip()[len(KEYWORD_BATCH):].split(BATCH_DELIMITER)]
+            commands = [command for command in commands if command]
+            if not commands or len(commands) > BATCH_MAX_COMMANDS:
+                error_message = f"Batch needs 1 to {BATCH_MAX_COMMANDS} commands separated by {BATCH_DELIMITER}"
+                send_sms_response(modem, phone_number, error_message)
+                logger.warning("Invalid batch size - Phone Number: %s - Command: %s", phone_number, content)
+                return
+            build_sms_response(modem, phone_number, run_batch(commands, phone_number))
             return
 
-        # If any command is not allowed, send a warning message
-        error_message = "Unauthorised command"
-        send_sms_response(modem, phone_number, error_message)
-        logger.warning("Unauthorised command - Phone Number: %s - Command: %s", phone_number, content)
+        # Run a single command and send its output
+        output = run_sms_command(content, phone_number)
+        build_sms_response(modem, phone_number, output)
 
     except ValueError as e:
         error_message = "An value error occurred while parsing the SMS."
@@ -478,7 +525,7 @@ def check_read_sms(modem):
     try:
         # Check for read SMS messages in modem memory
         modem.write(b'AT+CMGL="REC READ"\r\n')
-        response = modem.read_until(b'OK\r\n')
+        response = read_final_result(modem)
 
         # Count the number of read SMS messages in modem memory
         messages = response.decode(MODEM_CHAR_ENCODING).split('+CMGL: ')[1:]
@@ -531,7 +578,7 @@ def purge_all_sms(modem):
 def process_offline_messages(modem):
     try:
         modem.write(b'AT+CMGL="REC UNREAD"\r\n')
-        response = modem.read_until(b'OK\r\n')
+        response = read_final_result(modem)
         time.sleep(0.1)
 
         # Parse and process each waiting message
@@ -555,11 +602,469 @@ def process_offline_messages(modem):
         logger.error('An error occurred while processing offline messages: %s', str(e))
 
 
+# Poll quickly while SMS activity is recent, then back off exponentially to POLL_MAX_INTERVAL when idle
+def next_poll_interval(interval, last_activity):
+    if time.monotonic() - last_activity < POLL_ACTIVE_PERIOD:
+        return POLL_MIN_INTERVAL
+    return min(max(interval, POLL_MIN_INTERVAL) * POLL_BACKOFF_FACTOR, POLL_MAX_INTERVAL)
+
+
+# Let the modem sleep between polls. With AT+CSCLK=1 the modem may only sleep while DTR is released.
+def modem_sleep(modem):
+    power_stats['busy_seconds'] += time.monotonic() - power_stats['busy_since']
+    if MODEM_SLEEP_ENABLED:
+        modem.dtr = False
+
+
+# Wake the modem ready for the next poll
+def modem_wake(modem):
+    if MODEM_SLEEP_ENABLED:
+        modem.dtr = True
+        time.sleep(MODEM_WAKE_DELAY)
+    power_stats['busy_since'] = time.monotonic()
+    power_stats['wakeups'] += 1
+
+
+# Idle until the next poll is due, returning early if the modem signals a new SMS via +CMTI or the RI line
+def wait_for_activity(modem, interval):
+    deadline = time.monotonic() + interval
+    # Block on the serial port so the CPU can idle. The RI line can only be sampled, so wake briefly to check it.
+    # The timeout is set once here, as every change reconfigures the port.
+    modem.timeout = 0.1 if WAKE_ON_RI else interval
+    # Only wake when RI is newly asserted, so a held RI (e.g. during an incoming call) does not cause back to back polls
+    ri_was_on = WAKE_ON_RI and modem.ri
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            data = modem.read(1)
+            if data:
+                # Give the rest of the unsolicited result code time to arrive before checking it
+                time.sleep(0.1)
+                data += modem.read(modem.in_waiting)
+                if b'+CMTI' in data:
+                    return True
+                # An unrelated unsolicited result code woke the wait early, so shorten the timeout to the time left
+                if not WAKE_ON_RI:
+                    modem.timeout = max(deadline - time.monotonic(), 0)
+            elif WAKE_ON_RI:
+                ri_on = modem.ri
+                if ri_on and not ri_was_on:
+                    return True
+                ri_was_on = ri_on
+    finally:
+        modem.timeout = 1
+
+
+# Format the poll loop counters used to measure power savings
+def format_power_stats():
+    now = time.monotonic()
+    uptime = now - power_stats['started']
+    busy = power_stats['busy_seconds'] + now - power_stats['busy_since']
+    # Without modem sleep the modem radio is on for the whole uptime
+    awake = busy if MODEM_SLEEP_ENABLED else uptime
+    return (f"Uptime {uptime:.0f}s\nPolls {power_stats['polls']}\nWakeups {power_stats['wakeups']} "
+            f"(early {power_stats['early_wakeups']})\nBusy {busy:.0f}s\nModem awake {awake:.0f}s "
+            f"({100 * awake / max(uptime, 1):.1f}%)")
+
+
+# Log the power counters every POWER_STATS_INTERVAL seconds
+def log_power_stats():
+    if POWER_STATS_INTERVAL and time.monotonic() - power_stats['last_report'] >= POWER_STATS_INTERVAL:
+        logger.info('D: %s T: %s Power stats: %s', time.strftime('%Y-%m-%d'), time.strftime('%H:%M:%S'),
+                    format_power_stats().replace('\n', ', '))
+        power_stats['last_report'] = time.monotonic()
+
+
+# Convert a config file value to the type of the script default it overrides
+def parse_config_value(name, value):
+    default = config_defaults[name]
+    if isinstance(default, bool):
+        if value.strip().lower() in ('true', 'yes', 'on', '1'):
+            return True
+        if value.strip().lower() in ('false', 'no', 'off', '0'):
+            return False
+        raise ValueError(f"expected True or False, got '{value}'")
+    if isinstance(default, float) or name in CONFIG_FLOAT_SETTINGS:
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError(f"expected a number, got '{value}'")
+    if isinstance(default, int):
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"expected a whole number, got '{value}'")
+    # Keyword tags are matched against uppercase SMS content
+    if name.startswith('KEYWORD_') and not name.endswith('_CMD'):
+        return value.strip().upper()
+    return value
+
+
+# Check a complete set of settings for values the script cannot run with and return a list of problems
+def validate_config(config):
+    errors = []
+    for name, value in config.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if name in CONFIG_POSITIVE_SETTINGS and value <= 0:
+                errors.append(f'{name} must be greater than 0')
+            elif value < 0:
+                errors.append(f'{name} must not be negative')
+
+    if config['MAX_SMS_LENGTH'] > 153:
+        errors.append('MAX_SMS_LENGTH must be 153 or less to leave room for page numbering')
+    if config['POLL_MAX_INTERVAL'] < config['POLL_MIN_INTERVAL']:
+        errors.append('POLL_MAX_INTERVAL must not be less than POLL_MIN_INTERVAL')
+    if config['POLL_BACKOFF_FACTOR'] < 1:
+        errors.append('POLL_BACKOFF_FACTOR must be 1 or more')
+    if not config['BATCH_DELIMITER'].strip():
+        errors.append('BATCH_DELIMITER must not be empty')
+    if config['WATCHDOG_RETRY_MAX'] < config['WATCHDOG_RETRY_MIN']:
+        errors.append('WATCHDOG_RETRY_MAX must not be less than WATCHDOG_RETRY_MIN')
+
+    try:
+        codecs.lookup(config['MODEM_CHAR_ENCODING'])
+    except LookupError:
+        errors.append(f"MODEM_CHAR_ENCODING '{config['MODEM_CHAR_ENCODING']}' is not a known encoding")
+
+    for phone_number in config['ACL'].split(','):
+        if phone_number.strip() and not re.match(r'^\+?\d+$', phone_number.strip()):
+            errors.append(f"ACL entry '{phone_number.strip()}' is not a phone number")
+
+    if config['OTP_ENABLED']:
+        try:
+            pyotp.TOTP(config['TOTP_SECRET_KEY']).now()
+        except Exception:
+            errors.append('TOTP_SECRET_KEY is not a valid base32 secret key (run otp-setup.py)')
+
+    for name in ('CURRENT_DIR', 'LOG_FILE_PATH'):
+        if not os.path.isdir(config[name]):
+            errors.append(f"{name} '{config[name]}' is not a directory")
+    if os.path.isdir(config['CURRENT_DIR']) and not os.access(config['CURRENT_DIR'], os.X_OK):
+        errors.append(f"CURRENT_DIR '{config['CURRENT_DIR']}' can not be entered")
+    log_file = os.path.join(config['LOG_FILE_PATH'], config['LOG_FILE_NAME'])
+    if os.path.isdir(config['LOG_FILE_PATH']):
+        try:
+            with open(log_file, 'a'):
+                pass
+        except OSError as e:
+            errors.append(f"Log file '{log_file}' can not be opened: {e.strerror}")
+
+    keywords = [config[name] for name in CONFIG_SECTIONS['keywords'] if not name.endswith('_CMD')]
+    if '' in keywords:
+        errors.append('Keyword shortcuts must not be empty')
+    duplicates = sorted(set(keyword for keyword in keywords if keywords.count(keyword) > 1))
+    if duplicates:
+        errors.append('Keyword shortcuts are used more than once: {}'.format(', '.join(duplicates)))
+
+    return errors
+
+
+# Read CONFIG_FILE over the script defaults. Raises ValueError listing every problem found so nothing is half applied.
+def load_config(path):
+    config = dict(config_defaults)
+    if not os.path.exists(path):
+        return config
+
+    # Keep option names as uppercase to match the script settings, and take % characters in commands literally
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.optionxform = str.upper
+    try:
+        with open(path, encoding='utf-8') as file:
+            parser.read_file(file)
+    except (OSError, UnicodeDecodeError, configparser.Error) as e:
+        raise ValueError(f'Could not read config file {path}: {e}')
+
+    errors = []
+    for section in parser.sections():
+        if section.lower() not in CONFIG_SECTIONS:
+            errors.append(f'unknown section [{section}]')
+            continue
+        for name, value in parser.items(section):
+            if name not in CONFIG_SECTIONS[section.lower()]:
+                errors.append(f'unknown setting {name} in [{section}]')
+                continue
+            try:
+                config[name] = parse_config_value(name, value)
+            except ValueError as e:
+                errors.append(f'{name} {e}')
+
+    if not errors:
+        errors = validate_config(config)
+    if errors:
+        raise ValueError('Invalid config file {}: {}'.format(path, '; '.join(errors)))
+    return config
+
+
+# Apply settings to the running script. Modem init settings are only applied at startup, before the port is opened.
+def apply_config(config, startup=False):
+    global totp, file_handler, reply_queue
+    changed = [name for name, value in config.items() if globals()[name] != value]
+    deferred = [] if startup else [name for name in changed if name in MODEM_INIT_SETTINGS]
+    applied = [name for name in changed if name not in deferred]
+
+    # Open the new log file and enter the new directory first, so a failure leaves every current setting in place
+    new_handler = None
+    if set(applied) & {'LOG_FILE_PATH', 'LOG_FILE_NAME', 'MAX_LOG_FILE_SIZE', 'LOG_ROTATE_COUNT'}:
+        new_log_file = os.path.join(config['LOG_FILE_PATH'], config['LOG_FILE_NAME'])
+        new_handler = logging.handlers.RotatingFileHandler(new_log_file, maxBytes=config['MAX_LOG_FILE_SIZE'],
+                                                           backupCount=config['LOG_ROTATE_COUNT'])
+        new_handler.setFormatter(formatter)
+    if 'CURRENT_DIR' in applied:
+        try:
+            os.chdir(config['CURRENT_DIR'])
+        except OSError:
+            if new_handler is not None:
+                new_handler.close()
+            raise
+
+    for name in applied:
+        globals()[name] = config[name]
+
+    if 'TOTP_SECRET_KEY' in applied:
+        totp = pyotp.TOTP(TOTP_SECRET_KEY)
+
+    # Swap the log file handler over to the new log settings
+    if new_handler is not None:
+        logger.addHandler(new_handler)
+        logger.removeHandler(file_handler)
+        file_handler.close()
+        file_handler = new_handler
+
+    if 'REPLY_QUEUE_SIZE' in applied:
+        reply_queue = collections.deque(reply_queue, maxlen=REPLY_QUEUE_SIZE)
+
+    return applied, deferred
+
+
+# Load and apply CONFIG_FILE. At startup an invalid config file stops the script, on reload the current settings are kept.
+def reload_config(startup=False):
+    try:
+        config_state['mtime'] = os.stat(CONFIG_FILE).st_mtime
+    except OSError:
+        config_state['mtime'] = None
+
+    try:
+        config = load_config(CONFIG_FILE)
+    except ValueError as e:
+        if startup:
+            raise
+        logger.error('D: %s T: %s Config reload rejected, keeping current settings. %s',
+                     time.strftime('%Y-%m-%d'), time.strftime('%H:%M:%S'), str(e))
+        return
+
+    try:
+        applied, deferred = apply_config(config, startup)
+    except OSError as e:
+        if startup:
+            raise
+        logger.error('D: %s T: %s Config reload rejected, keeping current settings. %s',
+                     time.strftime('%Y-%m-%d'), time.strftime('%H:%M:%S'), str(e))
+        return
+
+    if applied and not startup:
+        logger.info('D: %s T: %s Config reloaded. Applied: %s',
+                    time.strftime('%Y-%m-%d'), time.strftime('%H:%M:%S'), ', '.join(applied))
+    if deferred:
+        logger.warning('D: %s T: %s Config changes need a modem re-init, restart the service to apply: %s',
+                       time.strftime('%Y-%m-%d'), time.strftime('%H:%M:%S'), ', '.join(deferred))
+
+
+# SIGHUP handler. The reload itself runs from the main loop so it never interrupts a modem exchange.
+def request_config_reload(signum, frame):
+    config_state['reload_requested'] = True
+
+
+# Reload the config file if a reload was requested or the file has changed since it was last loaded
+def check_config_reload():
+    try:
+        mtime = os.stat(CONFIG_FILE).st_mtime
+    except OSError:
+        mtime = None
+
+    if config_state['reload_requested'] or mtime != config_state['mtime']:
+        config_state['reload_requested'] = False
+        reload_config()
+
+
+# Send a cheap AT probe and check the modem answers
+def probe_modem(modem):
+    modem.write(b'AT\r\n')
+    return modem.read_until(b'OK\r\n').endswith(b'OK\r\n')
+
+
+# Check if a modem response ends with its final result code (OK, ERROR, +CME ERROR or +CMS ERROR)
+def has_final_result(response):
+    return response.endswith(b'OK\r\n') or re.search(rb'(^|\n)(\+CM[ES] )?ERROR(: *\d+)?\r\n$', response) is not None
+
+
+# Read a command response up to its final result code. A long response such as a full CMGL listing can take longer
+# than the port timeout, so keep reading while data is still arriving and only stop early once the modem goes quiet.
+# A command the modem answers slowly can wait up to wait seconds for the response to start.
+def read_final_result(modem, wait=0):
+    deadline = time.monotonic() + wait
+    response = b''
+    while True:
+        data = modem.read_until(b'OK\r\n')
+        response += data
+        if has_final_result(response) or (not data and time.monotonic() >= deadline):
+            return response
+
+
+# Watchdog check after each poll. Raises SerialException once the modem has missed WATCHDOG_MAX_FAILED_PROBES probes.
+def check_modem_health(modem, response):
+    if has_final_result(response) or probe_modem(modem):
+        watchdog_stats['failed_probes'] = 0
+        watchdog_stats['failed_since'] = None
+        # The modem answers again, so send any replies it missed without waiting for a reconnect
+        if reply_queue:
+            flush_sms_responses(modem)
+        return
+
+    # Recovery time is measured from the first missed probe
+    if watchdog_stats['failed_since'] is None:
+        watchdog_stats['failed_since'] = time.monotonic()
+    watchdog_stats['failed_probes'] += 1
+    logger.warning('Modem did not answer AT probe (%s of %s)', watchdog_stats['failed_probes'], WATCHDOG_MAX_FAILED_PROBES)
+    if watchdog_stats['failed_probes'] >= WATCHDOG_MAX_FAILED_PROBES:
+        watchdog_stats['failed_probes'] = 0
+        raise serial.SerialException('Modem stopped responding to AT probes')
+
+
+# Find the /dev/serial/by-id link for a modem device so it can still be found if it re-enumerates under a new tty name
+def find_modem_by_id(device):
+    for link in glob.glob('/dev/serial/by-id/*'):
+        if os.path.realpath(link) == os.path.realpath(device):
+            return link
+    return None
+
+
+# Pick the device to open. Once the by-id link for the modem is known it is used first, because after a USB
+# re-enumeration the MODEM tty name may have gone or may now belong to another interface of the modem.
+def resolve_modem_device():
+    by_id = watchdog_stats['by_id']
+    if by_id and os.path.exists(by_id):
+        if os.path.realpath(by_id) != os.path.realpath(MODEM):
+            logger.warning('Modem %s has moved, using %s (now %s)', MODEM, by_id, os.path.realpath(by_id))
+        return by_id
+    return MODEM
+
+
+# Send the one time modem parameter settings. Also run after every reconnect.
+def configure_modem(modem):
+    # Set GPS on or off
+    modem.write((GPS_CONFIG + '\r\n').encode(MODEM_CHAR_ENCODING))
+    modem.read_until(b'OK\r\n')
+    time.sleep(0.1)
+
+    # Set SMS message format mode
+    modem.write((MODEM_MSG_FORMAT + '\r\n').encode(MODEM_CHAR_ENCODING))
+    modem.read_until(b'OK\r\n')
+    time.sleep(0.1)
+
+    # Set SMS storage location config
+    modem.write((MODEM_MSG_STOR + '\r\n').encode(MODEM_CHAR_ENCODING))
+    modem.read_until(b'OK\r\n')
+    time.sleep(0.1)
+
+    # Set modem character encoding
+    modem.write((MODEM_CHAR_SET + '\r\n').encode(MODEM_CHAR_ENCODING))
+    modem.read_until(b'OK\r\n')
+    time.sleep(0.1)
+
+    # Set modem text mode parameters
+    modem.write((MODEM_TXT_MODE_PARAM + '\r\n').encode(MODEM_CHAR_ENCODING))
+    modem.read_until(b'OK\r\n')
+    time.sleep(0.1)
+
+    # Enable new SMS notifications so the idle poll loop can wake early
+    modem.write((MODEM_NEW_MSG_IND + '\r\n').encode(MODEM_CHAR_ENCODING))
+    modem.read_until(b'OK\r\n')
+    time.sleep(0.1)
+
+    # Set modem sleep mode, holding DTR asserted to keep the modem awake until the poll loop idles
+    if MODEM_SLEEP_ENABLED:
+        modem.dtr = True
+        modem.write((MODEM_SLEEP_CONFIG + '\r\n').encode(MODEM_CHAR_ENCODING))
+        modem.read_until(b'OK\r\n')
+        time.sleep(0.1)
+
+
+# Open and configure the modem, retrying with exponential back off until it answers
+def connect_modem():
+    retry_delay = WATCHDOG_RETRY_MIN
+    while True:
+        modem = None
+        try:
+            device = resolve_modem_device()
+            modem = serial.Serial(device, MODEM_BAUD_RATE, timeout=1)
+            time.sleep(0.1)
+            if MODEM_SLEEP_ENABLED:
+                modem.dtr = True
+                time.sleep(MODEM_WAKE_DELAY)
+            if not probe_modem(modem):
+                raise serial.SerialException(f'No answer to AT probe on {device}')
+            time.sleep(0.1)
+            configure_modem(modem)
+
+            if watchdog_stats['by_id'] is None:
+                watchdog_stats['by_id'] = find_modem_by_id(device)
+            return modem
+
+        except (serial.SerialException, OSError) as e:
+            if modem is not None:
+                modem.close()
+            logger.error('D: %s T: %s Modem connection attempt failed, retrying in %ss: %s',
+                         time.strftime('%Y-%m-%d'), time.strftime('%H:%M:%S'), retry_delay, str(e))
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, WATCHDOG_RETRY_MAX)
+
+
+# Replace a failed modem connection in process, then resend any replies queued while it was down. Recovery time runs
+# from the first missed probe, or from now for a serial error with no probes missed beforehand.
+def reconnect_modem(modem):
+    started = watchdog_stats['failed_since'] or time.monotonic()
+    try:
+        modem.close()
+    except Exception as e:
+        logger.error('An error occurred while closing the failed modem connection: %s', str(e))
+
+    modem = connect_modem()
+
+    recovery_time = time.monotonic() - started
+    watchdog_stats['failed_since'] = None
+    watchdog_stats['reconnects'] += 1
+    watchdog_stats['last_recovery'] = recovery_time
+    watchdog_stats['longest_recovery'] = max(watchdog_stats['longest_recovery'], recovery_time)
+    watchdog_stats['total_downtime'] += recovery_time
+    logger.info('D: %s T: %s Modem reconnected on %s after %.1fs, %s queued replies',
+                time.strftime('%Y-%m-%d'), time.strftime('%H:%M:%S'), modem.port, recovery_time, len(reply_queue))
+
+    # The modem is awake again, restart the busy time count the failed poll loop left open
+    power_stats['busy_since'] = time.monotonic()
+    flush_sms_responses(modem)
+    return modem
+
+
+# Format the modem watchdog counters
+def format_watchdog_stats():
+    return (f"Reconnects {watchdog_stats['reconnects']}\nLast recovery {watchdog_stats['last_recovery']:.1f}s\n"
+            f"Longest recovery {watchdog_stats['longest_recovery']:.1f}s\n"
+            f"Total downtime {watchdog_stats['total_downtime']:.1f}s\nQueued replies {len(reply_queue)}")
+
+
 def main():
+    modem = None
     try:
         # Commands before the while true loop run once at script start. These commands set the modem and SMS user
         # environment with the desired settings.
 
+        # Load the optional config file and reload it on SIGHUP
+        reload_config(startup=True)
+        signal.signal(signal.SIGHUP, request_config_reload)
+
         # Delay to ensure the modem is up and ready to accept the below configuration commands
         time.sleep(MODEM_DELAY)
 
@@ -567,56 +1072,38 @@ def main():
         switch_to_directory()
 
         # Initialise the modem connection
-        with serial.Serial(MODEM, MODEM_BAUD_RATE, timeout=1) as modem:
-            time.sleep(0.1)
-            modem.write(b'AT\r\n')
-            modem.read_until(b'OK\r\n')
-            time.sleep(0.1)
-
-            # Set GPS on or off
-            modem.write((GPS_CONFIG + '\r\n').encode(MODEM_CHAR_ENCODING))
-            modem.read_until(b'OK\r\n')
-            time.sleep(0.1)
-
-            # Set SMS message format mode
-            modem.write((MODEM_MSG_FORMAT + '\r\n').encode(MODEM_CHAR_ENCODING))
-            modem.read_until(b'OK\r\n')
-            time.sleep(0.1)
-
-            # Set SMS storage location config
-            modem.write((MODEM_MSG_STOR + '\r\n').encode(MODEM_CHAR_ENCODING))
-            modem.read_until(b'OK\r\n')
-            time.sleep(0.1)
-
-            # Set modem character encoding
-            modem.write((MODEM_CHAR_SET + '\r\n').encode(MODEM_CHAR_ENCODING))
-            modem.read_until(b'OK\r\n')
-            time.sleep(0.1)
+        modem = connect_modem()
+
+        if PURGE_ALL_ON_START:
+            # We may not want messages to queue up while offline, this clears the slate on startup
+            purge_all_sms(modem)
+            time.sleep(0.5)
+        else:
+            # Perform modem memory housekeeping and delete only read and previously sent messages on startup
+            purge_proc_sms(modem)
+            time.sleep(0.5)
 
-            # Set modem text mode parameters
-            modem.write((MODEM_TXT_MODE_PARAM + '\r\n').encode(MODEM_CHAR_ENCODING))
-            modem.read_until(b'OK\r\n')
-            time.sleep(0.1)
+        # Process waiting messages
+        process_offline_messages(modem)
 
-            if PURGE_ALL_ON_START:
-                # We may not want messages to queue up while offline, this clears the slate on startup
-                purge_all_sms(modem)
-                time.sleep(0.5)
-            else:
-                # Perform modem memory housekeeping and delete only read and previously sent messages on startup
-                purge_proc_sms(modem)
-                time.sleep(0.5)
-
-            # Process waiting messages
-            process_offline_messages(modem)
+        poll_interval = POLL_MIN_INTERVAL
+        last_activity = time.monotonic()
 
         # Loop commands:
-            while True:
+        while True:
+            try:
+                # Apply any config file changes before polling
+                check_config_reload()
+
                 # Check for new SMS messages
+                power_stats['polls'] += 1
                 modem.write(b'AT+CMGL="REC UNREAD"\r\n')
-                response = modem.read_until(b'OK\r\n')
+                response = read_final_result(modem)
                 time.sleep(0.1)
 
+                # A poll with no final result code may mean the modem has hung, so confirm with an AT probe
+                check_modem_health(modem, response)
+
                 # Parse and process each SMS message
                 messages = response.decode(MODEM_CHAR_ENCODING).split('+CMGL: ')[1:]
                 for message in messages:
@@ -624,15 +1111,38 @@ def main():
                     process_sms(modem, message)
                     time.sleep(0.5)
 
-                # Check the level of stored messages in memory for batch delete
-                check_read_sms(modem)
-
-                # Wait for a little before checking again
-                time.sleep(1)
+                if messages:
+                    last_activity = time.monotonic()
+                    # Read messages only build up when new messages are processed, so only check for batch delete then
+                    check_read_sms(modem)
+
+                log_power_stats()
+
+                # Idle until the next poll is due or a new SMS arrives
+                poll_interval = next_poll_interval(poll_interval, last_activity)
+                # Keep polling quickly while the modem is missing probes so a hang is confirmed without delay
+                if watchdog_stats['failed_probes']:
+                    poll_interval = POLL_MIN_INTERVAL
+                modem_sleep(modem)
+                woke_early = wait_for_activity(modem, poll_interval)
+                modem_wake(modem)
+                if woke_early:
+                    power_stats['early_wakeups'] += 1
+
+            except (serial.SerialException, OSError) as e:
+                # Modem lost or hung, reconnect in place rather than exiting and waiting for a service restart
+                logger.error('D: %s T: %s Modem connection failed: %s',
+                             time.strftime('%Y-%m-%d'), time.strftime('%H:%M:%S'), str(e))
+                modem = reconnect_modem(modem)
+                poll_interval = POLL_MIN_INTERVAL
 
     except Exception as e:
         logger.error('An error occurred in the main function: %s', str(e))
 
+    finally:
+        if modem is not None:
+            modem.close()
+
 
 if __name__ == '__main__':
     main()